@@ -11,19 +11,174 @@
 
 
 from Hologram.HologramCloud import HologramCloud, CustomCloud
+from Hologram.Network.Modem.NovaM import NovaM
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import math
 import os
 import re
 import requests
+import serial
+from serial.tools import list_ports
 import shutil
+import statistics
 import sys
 import time
-from xmodem import XMODEM
+from xmodem import XMODEM, ACK
 import zipfile
 
 class UpdaterException(Exception):
     pass
 
+class XmodemLinkException(UpdaterException):
+    pass
+
+class ModemShutdownException(UpdaterException):
+    pass
+
+class XmodemLinkStats(object):
+    # Tracks round trip times and NAK/timeout rates for the blocks of an
+    # xmodem transfer so the read timeout and retry budget can follow
+    # what the link is actually doing instead of fixed worst case values.
+    # The RTT estimator is the usual smoothed RTT + 4 * variance one.
+    # Like TCP it follows Karn's rule: blocks that had to be resent give
+    # no RTT samples and a timeout backoff sticks until a block sent only
+    # once is ACKed. Only timeouts count towards giving up early, NAKs come
+    # back quickly and USB glitches tend to send a burst of them.
+    initial_timeout = 20
+    # the modem can hold an ACK for several seconds while it writes flash,
+    # reading less than that makes us resend blocks it already has
+    min_timeout = 10
+    max_timeout = 90
+    min_write_timeout = 5
+    # waiting for the modem to start the transfer, xmodem retries this
+    handshake_timeout = 1
+    # most time spent waiting on replies to one block before giving up,
+    # a dead link gets there in four timeouts instead of backing off to
+    # max_timeout over and over
+    max_block_wait = 180
+    min_retry = 4
+    max_retry = 25
+    # target chance of giving up on a block that would have gone through
+    give_up_probability = 0.001
+    # a link that fails more than this share of blocks is not worth
+    # finishing the transfer on
+    hopeless_error_rate = 0.5
+    hopeless_min_attempts = 20
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.start_transfer()
+
+    def start_transfer(self):
+        # keep the RTT estimate between files since the link is the
+        # same, but start counting errors and backing off fresh
+        self.backed_off = False
+        self.update_timeout()
+        self.attempts = 0
+        self.acks = 0
+        self.naks = 0
+        self.timeouts = 0
+        self.consecutive_timeouts = 0
+        self.block_wait = 0
+        self.sent_at = None
+        self.last_block = None
+        self.retransmitted = False
+
+    def block_sent(self, block):
+        # xmodem resends the exact same block after a NAK or timeout
+        if block == self.last_block:
+            self.retransmitted = True
+        else:
+            self.last_block = block
+            self.retransmitted = False
+        self.sent_at = time.time()
+
+    def response(self, char):
+        if self.sent_at is None:
+            # not waiting on a block, e.g. during protocol start
+            return
+        rtt = time.time() - self.sent_at
+        self.sent_at = None
+        self.attempts += 1
+        if not char:
+            self.timeouts += 1
+            self.consecutive_timeouts += 1
+            self.block_wait += rtt
+            self.timeout = min(self.timeout * 2, self.max_timeout)
+            self.backed_off = True
+            return
+        self.consecutive_timeouts = 0
+        if char == ACK:
+            self.acks += 1
+            self.block_wait = 0
+        else:
+            self.naks += 1
+            self.block_wait += rtt
+        if self.retransmitted:
+            # can't tell which send this is the reply to
+            return
+        if char == ACK:
+            self.backed_off = False
+        self.add_rtt_sample(rtt)
+
+    def add_rtt_sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.update_timeout()
+
+    def update_timeout(self):
+        if self.backed_off:
+            return
+        if self.srtt is None:
+            self.timeout = self.initial_timeout
+            return
+        timeout = self.srtt + 4 * self.rttvar
+        self.timeout = max(self.min_timeout, min(timeout, self.max_timeout))
+
+    def error_rate(self):
+        # smoothed so a couple of early errors do not look like a dead link
+        return (self.naks + self.timeouts + 1.0) / (self.attempts + 2.0)
+
+    def retry_budget(self):
+        # enough timeouts in a row that a block only gets given up on with
+        # give_up_probability at the current error rate
+        rate = self.error_rate()
+        if rate >= 1:
+            return self.max_retry
+        budget = int(math.ceil(math.log(self.give_up_probability) / math.log(rate)))
+        return max(self.min_retry, min(budget, self.max_retry))
+
+    def check_link(self):
+        if self.consecutive_timeouts > self.retry_budget():
+            raise XmodemLinkException('Too many consecutive xmodem timeouts',
+                    self.consecutive_timeouts)
+        if self.block_wait > self.max_block_wait:
+            raise XmodemLinkException('Too long waiting on an xmodem block',
+                    self.block_wait)
+        if (self.attempts >= self.hopeless_min_attempts
+                and self.error_rate() > self.hopeless_error_rate):
+            raise XmodemLinkException('xmodem error rate too high',
+                    self.error_rate())
+
+    def summary(self):
+        srtt = self.srtt if self.srtt is not None else 0
+        return ('%d blocks sent, %d acks, %d naks, %d timeouts, '
+                'srtt %.3fs, timeout %.1fs' % (self.attempts, self.acks,
+                    self.naks, self.timeouts, srtt, self.timeout))
+
+class DeviceLoggerAdapter(logging.LoggerAdapter):
+    # prefixes messages with the modem's USB location so output from
+    # several modems being verified at once can be told apart
+    def process(self, msg, kwargs):
+        return '[%s] %s' % (self.extra['location'], msg), kwargs
+
 class NovaR410Updater(object):
 
     # The file structure is fairly complicated as it depends on
@@ -99,9 +254,23 @@ class NovaR410Updater(object):
         }
     firmware_url = 'https://ublox-firmware.s3.amazonaws.com/'
 
-    def __init__(self):
+    # Post update verification. Boards hit by the shutdown loop described
+    # in the README drop off about a minute after getting on the network
+    expected_mno_profile = '0'
+    recovery_mno_profile = '2'
+    attach_timeout = 300
+    attach_poll_interval = 2
+    shutdown_watch_time = 120
+
+    def __init__(self, usb_location=None):
         self.logger = logging.getLogger('Nova410Updater')
+        if usb_location is not None:
+            self.logger = DeviceLoggerAdapter(self.logger,
+                    {'location': usb_location})
+        self.usb_location = usb_location
         self.cloud = None
+        self.modem = None
+        self.link_stats = XmodemLinkStats()
 
     def prompt_for_confirm(self):
         self.logger.debug('Checking for confirmation')
@@ -146,13 +315,13 @@ Do you wish to continue? (y/n) '''
 
     def check_modem_type(self):
         self.logger.warning('Confirming modem type')
-        modem_type = self.cloud.network.modem.modem_id
+        modem_type = self.modem.modem_id
         if modem_type == 'SARA-R410M-02B':
             return True
         raise UpdaterException('Unsupported modem type')
 
     def get_modem_version_digits(self):
-        version = self.cloud.network.modem._basic_command('I9')
+        version = self.modem._basic_command('I9')
         self.logger.warning('Got version %s', version)
         res = re.match(r'^L0\.0\.00\.00\.05\.0[68],A\.02\.(\d+)$', version)
         if res is None:
@@ -170,7 +339,50 @@ Do you wish to continue? (y/n) '''
         return '02' + digits
 
     def init_cloud(self):
-        self.cloud = CustomCloud(None, network='cellular')
+        if self.usb_location is None:
+            self.cloud = CustomCloud(None, network='cellular')
+            self.modem = self.cloud.network.modem
+        else:
+            # the SDK only ever picks the first modem it finds so open the
+            # one at our USB location directly. Port names can change when
+            # the modem restarts but the USB location stays the same
+            self.modem = self.open_modem_at_location(self.usb_location)
+
+    def open_modem_at_location(self, location):
+        ports = [port.device for port in list_ports.comports()
+                if port.location and port.location.split(':')[0] == location]
+        for port in sorted(ports):
+            # the R410 has several serial interfaces, only use the one
+            # that answers AT
+            if not self.port_answers_at(port):
+                self.logger.debug('No AT response on %s', port)
+                continue
+            try:
+                return NovaM(device_name=port)
+            except Exception as e:
+                self.logger.debug('No usable modem on %s: %s', port, e)
+        raise UpdaterException('No modem found at USB location', location)
+
+    def port_answers_at(self, port):
+        try:
+            with serial.Serial(port, 115200, timeout=1) as ser:
+                ser.reset_input_buffer()
+                ser.write(b'AT\r')
+                return b'OK' in ser.read(64)
+        except serial.SerialException as e:
+            self.logger.debug('Could not probe %s: %s', port, e)
+            return False
+
+    def close_modem(self):
+        # verification reopens each modem several times, don't leave the
+        # old serial port open behind it
+        if self.modem is not None and self.modem.serial_port is not None:
+            try:
+                self.modem.serial_port.close()
+            except Exception as e:
+                self.logger.debug('Error closing serial port: %s', e)
+        self.cloud = None
+        self.modem = None
 
 
     def run_update(self, only_checks = False):
@@ -186,26 +398,71 @@ Do you wish to continue? (y/n) '''
         self.logger.warning('This could take 20 minutes. Do not unplug the modem')
         self.watch_for_stage2_complete()
         self.reprogram_leds()
-        self.cloud.network.modem.reset()
-        self.logger.warning('Done')
+        try:
+            result = self.verify_update()
+        except UpdaterException as e:
+            self.logger.error('Update installed, verification failed: %s', e)
+            self.logger.error('See the Troubleshooting section in README.md')
+            return True
+        self.logger.warning('Done. Network attach took %.1f seconds',
+                result['attach_time'])
         return True
 
+    def run_verify(self):
+        self.init_cloud()
+        self.check_modem_type()
+        return self.verify_update()
+
     def xgetc(self, size, timeout=1):
-        return self.cloud.network.modem.serial_port.read(size)
+        serial_port = self.modem.serial_port
+        if self.link_stats.sent_at is None:
+            serial_port.timeout = XmodemLinkStats.handshake_timeout
+        else:
+            serial_port.timeout = self.link_stats.timeout
+        data = serial_port.read(size)
+        self.link_stats.response(data)
+        return data
 
     def xputc(self, data, timeout=1):
-        return self.cloud.network.modem.serial_port.write(data)
+        serial_port = self.modem.serial_port
+        serial_port.write_timeout = max(self.link_stats.timeout,
+                XmodemLinkStats.min_write_timeout)
+        # xmodem writes each block in one go, anything bigger than a
+        # single control byte is a block we are now waiting on
+        if len(data) > 1:
+            self.link_stats.block_sent(data)
+            if self.link_stats.retransmitted:
+                # drop a late reply to the previous send so it isn't taken
+                # as the reply to this one
+                serial_port.reset_input_buffer()
+        return serial_port.write(data)
+
+    def xmodem_callback(self, total_packets, success_count, error_count):
+        self.link_stats.check_link()
 
     def send_file(self, filename):
         self.logger.warning('Sending file %s', filename)
-        self.cloud.network.modem.serial_port.write_timeout = 20
-        self.cloud.network.modem.command('+UFWUPD', '3', expected='ONGOING', timeout=60)
+        self.modem.command('+UFWUPD', '3', expected='ONGOING', timeout=60)
         time.sleep(5)
         fd = open(filename, 'rb')
         self.logger.warning('Writing file to serial port')
         modem = XMODEM(self.xgetc, self.xputc)
-        sent_success = modem.send(fd, retry=25, timeout=90)
-        fd.close()
+        serial_port = self.modem.serial_port
+        read_timeout = serial_port.timeout
+        self.link_stats.start_transfer()
+        try:
+            sent_success = modem.send(fd, retry=XmodemLinkStats.max_retry,
+                    timeout=XmodemLinkStats.max_timeout,
+                    callback=self.xmodem_callback)
+        except XmodemLinkException:
+            self.logger.warning('Link too unreliable, aborting transfer: %s',
+                    self.link_stats.summary())
+            modem.abort(timeout=1)
+            raise
+        finally:
+            fd.close()
+            serial_port.timeout = read_timeout
+        self.logger.debug('xmodem link: %s', self.link_stats.summary())
         if not sent_success:
             raise UpdaterException('Failed to send file via xmodem')
         self.logger.debug('Done writing')
@@ -213,7 +470,7 @@ Do you wish to continue? (y/n) '''
         return True
 
     def install_loaded_firmware(self):
-        res, resp = self.cloud.network.modem.command('+UFWINSTALL', timeout=60)
+        res, resp = self.modem.command('+UFWINSTALL', timeout=60)
         if res == 'Error':
             raise UpdaterException('Firmware Install failed')
         time.sleep(1)
@@ -226,7 +483,10 @@ Do you wish to continue? (y/n) '''
             #stage 1
             for filename in package[0]:
                 fw_file = os.path.join(package_dir, filename)
-                self.send_file(fw_file)
+                try:
+                    self.send_file(fw_file)
+                except XmodemLinkException:
+                    self.abort_on_bad_link()
                 self.install_loaded_firmware()
                 res = self.check_for_stage1_return_code()
                 if res == 'OK':
@@ -245,17 +505,32 @@ Do you wish to continue? (y/n) '''
             #stage 2
             filename = package[1][0]
             fw_file = os.path.join(package_dir, filename)
-            self.send_file(fw_file)
+            try:
+                self.send_file(fw_file)
+            except XmodemLinkException:
+                self.abort_on_bad_link()
             self.install_loaded_firmware()
             return
         # looped through everything without success
         raise UpdaterException('Was unable to install any update package successfully')
 
 
+    def abort_on_bad_link(self):
+        # every other file would go over the same link so stop here. The
+        # modem doesn't restart after an aborted transfer, it only has to
+        # drop out of +UFWUPD mode
+        self.logger.warning('Transfer aborted')
+        try:
+            self.wait_for_at_mode(61)
+        except UpdaterException as e:
+            self.logger.warning(str(e))
+        raise UpdaterException('Link to modem too unreliable to send '
+                'firmware. Check the USB connection and try again')
+
     def check_for_stage1_return_code(self):
         self.logger.warning('Waiting for stage1 return code')
         self.wait_for_modem(61)
-        result, response = self.cloud.network.modem.command('+UFWSTATUS?')
+        result, response = self.modem.command('+UFWSTATUS?')
         fwstatus = re.match(r'\+UFWSTATUS: (\w+), (\w+), (\w+)', response)
         if not fwstatus:
             raise UpdaterException('Invalid UFWSTATUS response', fwstatus)
@@ -279,25 +554,39 @@ Do you wish to continue? (y/n) '''
 
 
     def reprogram_leds(self):
-        self.cloud.network.modem.command('+UGPIOC', '23,10')
-        self.cloud.network.modem.command('+UGPIOC', '16,2')
+        self.modem.command('+UGPIOC', '23,10')
+        self.modem.command('+UGPIOC', '16,2')
 
-    def wait_for_modem(self, maxtime):
+    def wait_for_modem(self, maxtime, poll_interval=30,
+            message='Still waiting for modem to finish install. Do not unplug'):
         self.logger.warning('Waiting for modem')
         stop_at = time.time() + maxtime
         while time.time() < stop_at:
-            self.cloud = None
+            self.close_modem()
             try:
                 self.init_cloud()
             except Exception as e:
-                time.sleep(30)
-                self.logger.warning(
-                        'Still waiting for modem to finish install. Do not unplug')
+                time.sleep(poll_interval)
+                self.logger.warning(message)
                 continue
             break
-        if self.cloud is None:
+        if self.modem is None:
             raise UpdaterException('Failed to detect modem after maximum time')
 
+    def wait_for_at_mode(self, maxtime):
+        # an aborted transfer can leave the modem in +UFWUPD mode for a
+        # while, wait until it answers a plain AT again
+        stop_at = time.time() + maxtime
+        while time.time() < stop_at:
+            try:
+                res, resp = self.modem.command()
+            except Exception as e:
+                res = 'Error'
+            if res == 'OK':
+                return
+            time.sleep(1)
+        raise UpdaterException('Modem did not leave firmware update mode')
+
     def watch_for_stage2_complete(self):
         # We should see the usb and serial ports go away while the install is
         # running so we watch for them to come back up and then run ATI9 to
@@ -310,8 +599,156 @@ Do you wish to continue? (y/n) '''
         else:
             raise UpdaterException('Got unexpected modem version', digits)
 
+    def get_mno_profile(self):
+        try:
+            result, response = self.modem.command('+UMNOPROF?')
+        except Exception as e:
+            raise UpdaterException('Lost modem while reading MNO profile', e)
+        profile = re.match(r'\+UMNOPROF: (\d+)', response or '')
+        if result != 'OK' or not profile:
+            raise UpdaterException('Invalid UMNOPROF response', response)
+        return profile.group(1)
+
+    def verify_update(self):
+        # Confirms the new firmware is running and that the modem gets on
+        # the network and stays there after a restart. Modems that shut
+        # down after attaching get the CFUN/UMNOPROF recovery from the
+        # README troubleshooting section and are checked again
+        self.logger.warning('Verifying update')
+        result = verify_result(self.usb_location)
+        digits = self.get_modem_version_digits()
+        if digits != '04':
+            raise UpdaterException('Got unexpected modem version', digits)
+        result['mno_profile'] = self.get_mno_profile()
+        if result['mno_profile'] != self.expected_mno_profile:
+            self.logger.warning('Modem is using MNO profile %s',
+                    result['mno_profile'])
+        result['attach_time'] = self.measure_attach_time()
+        try:
+            self.watch_for_shutdown_loop()
+        except ModemShutdownException as e:
+            self.logger.warning('%s. Applying MNO profile recovery', e)
+            self.wait_for_restart()
+            self.recover_mno_profile()
+            result['recovered'] = True
+            result['mno_profile'] = self.get_mno_profile()
+            result['attach_time'] = self.measure_attach_time()
+            self.watch_for_shutdown_loop()
+        return result
+
+    def wait_for_restart(self):
+        # give the modem time to drop off USB so we don't find the old ports
+        time.sleep(5)
+        self.wait_for_modem(self.attach_timeout, poll_interval=1,
+                message='Still waiting for modem to restart')
+
+    def measure_attach_time(self):
+        self.logger.warning('Restarting modem and timing network attach')
+        start = time.time()
+        try:
+            self.modem.reset()
+        except Exception as e:
+            raise UpdaterException('Lost modem while restarting it', e)
+        self.wait_for_restart()
+        while time.time() - start < self.attach_timeout:
+            try:
+                registered = self.modem.is_registered()
+            except Exception as e:
+                raise UpdaterException('Lost modem while waiting for network', e)
+            if registered:
+                attach_time = time.time() - start
+                self.logger.warning('Attached to network after %.1f seconds',
+                        attach_time)
+                return attach_time
+            time.sleep(self.attach_poll_interval)
+        raise UpdaterException('Modem did not attach to network')
+
+    def watch_for_shutdown_loop(self):
+        self.logger.warning('Checking that modem stays on the network')
+        stop_at = time.time() + self.shutdown_watch_time
+        while time.time() < stop_at:
+            try:
+                res, resp = self.modem.command()
+            except Exception as e:
+                res = 'Error'
+            if res != 'OK':
+                raise ModemShutdownException('Modem shut down after attaching')
+            time.sleep(self.attach_poll_interval)
+
+    def recovery_command(self, cmd, value, **kwargs):
+        try:
+            res, resp = self.modem.command(cmd, value, **kwargs)
+        except Exception as e:
+            raise UpdaterException('Lost modem during recovery', cmd, e)
+        if res != 'OK':
+            raise UpdaterException('Recovery command failed', cmd, value, res)
+
+    def recover_mno_profile(self):
+        for profile in (self.recovery_mno_profile, self.expected_mno_profile):
+            self.recovery_command('+CFUN', '0', timeout=10)
+            self.recovery_command('+UMNOPROF', profile)
+            self.recovery_command('+CFUN', '15')
+            self.wait_for_restart()
+            time.sleep(5)
+
+
+def list_usb_locations():
+    locations = set()
+    for usb_id in NovaM.usb_ids:
+        for port in list_ports.grep('%s:%s' % usb_id):
+            if port.location:
+                locations.add(port.location.split(':')[0])
+    return sorted(locations)
+
+def verify_result(location, error=None):
+    return {'location': location, 'mno_profile': None, 'attach_time': None,
+            'recovered': False, 'error': error}
+
+def verify_device(location):
+    upd = NovaR410Updater(usb_location=location)
+    try:
+        return upd.run_verify()
+    except Exception as e:
+        upd.logger.error('ERROR: ' + str(e))
+        return verify_result(location, error=str(e))
+    finally:
+        upd.close_modem()
+
+def verify_fleet(locations):
+    # Modems spend most of verification waiting on restarts and the
+    # network so check them all at once
+    with ThreadPoolExecutor(max_workers=len(locations)) as executor:
+        return list(executor.map(verify_device, locations))
+
+def report_attach_stats(results, logger):
+    attach_times = [r['attach_time'] for r in results if r['error'] is None]
+    failed = [r['location'] for r in results if r['error'] is not None]
+    recovered = [r['location'] for r in results if r['recovered']]
+    logger.warning('Verified %d of %d modems', len(attach_times), len(results))
+    if recovered:
+        logger.warning('Needed MNO profile recovery: %s', ', '.join(recovered))
+    if failed:
+        logger.warning('Failed verification: %s', ', '.join(failed))
+    if not attach_times:
+        return
+    attach_times.sort()
+    p90 = attach_times[int(math.ceil(0.9 * len(attach_times))) - 1]
+    logger.warning('Network attach seconds: min %.1f, median %.1f, '
+            'mean %.1f, p90 %.1f, max %.1f', attach_times[0],
+            statistics.median(attach_times), statistics.mean(attach_times),
+            p90, attach_times[-1])
+
 
 def main():
+    parser = argparse.ArgumentParser(
+            description='Update the u-blox firmware on a Hologram Nova R410')
+    parser.add_argument('--verify-only', action='store_true',
+            help='skip the update and only run post update verification')
+    parser.add_argument('--usb-location', action='append',
+            help='USB location (e.g. 1-1.2) of a modem to verify. Can be '
+            'given more than once. Defaults to all attached Nova R410s')
+    args = parser.parse_args()
+
     logger = logging.getLogger('')
     logger.setLevel(logging.DEBUG)
     sh = logging.StreamHandler()
@@ -324,6 +761,15 @@ def main():
     logger.addHandler(fh)
     logger.debug('Started')
 
+    if args.verify_only:
+        locations = args.usb_location or list_usb_locations()
+        if not locations:
+            logger.error('ERROR: No Nova R410 modems found')
+            sys.exit(1)
+        results = verify_fleet(locations)
+        report_attach_stats(results, logger)
+        sys.exit(0 if all(r['error'] is None for r in results) else 1)
+
     upd = NovaR410Updater()
     if not upd.prompt_for_confirm():
         sys.exit(0)